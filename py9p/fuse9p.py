@@ -40,6 +40,12 @@ MAX_RECONNECT_INTERVAL = 1024
 IOUNIT = 1024 * 16
 FAIL_TRIES = 2
 FAIL_TIMEOUT = 0.5
+CACHE_SIZE = 1024 * 1024 * 1024
+DIRCACHE_SIZE = 16384
+MAX_DIRCURSORS = 64
+COPY_FILES = 4
+COPY_DEPTH = 4
+PIPELINE_WINDOW = 1024 * 64
 
 uid_map = {}
 gid_map = {}
@@ -111,14 +117,23 @@ def guard(c):
         * acqiures and releases temporary fid
         * deals with py9p RPC errors
         * triggers reconnect() on network errors
+
+    Nested guarded calls leave the network errors to the outermost
+    one: it holds self._rlock, that the reconnection needs, and
+    retries the whole operation.
     """
     def wrapped(self, *argv, **kwarg):
         ret = -errno.EIO
+        depth = getattr(self._guarded, 'depth', 0)
         for i in range(FAIL_TRIES):
             try:
                 tfid = self.tfidcache.acquire()
-                with self._rlock:
-                    ret = c(self, tfid.fid, *argv, **kwarg)
+                self._guarded.depth = depth + 1
+                try:
+                    with self._rlock:
+                        ret = c(self, tfid.fid, *argv, **kwarg)
+                finally:
+                    self._guarded.depth = depth
                 self.tfidcache.release(tfid)
                 break
             except NoFidError:
@@ -128,6 +143,8 @@ def guard(c):
                 ret = rpccodes.get(e.message.lower(), -errno.EIO)
                 break
             except:
+                if depth:
+                    raise
                 if self.debug:
                     traceback.print_exc()
                 if self.keep_reconnect:
@@ -189,6 +206,223 @@ class Fid(object):
     def __init__(self, fid, iounit=IOUNIT):
         self.fid = fid
         self.iounit = iounit
+        self.cache = None
+        self.fill = None
+        # open() arguments, to reopen after reconnection
+        self.path = None
+        self.mode = 0
+        self.session = 0
+        # FUSE open flags
+        self.keep_cache = False
+        self.direct_io = False
+
+
+class CopyJob(object):
+    """
+    File copy state for the rename() fallback
+    """
+    def __init__(self, path, dest, size):
+        self.path = path
+        self.dest = dest
+        self.size = size
+        self.offset = 0
+        self.eof = size == 0
+        self.sf = None
+        self.df = None
+
+
+class DirCursor(object):
+    """
+    Open directory listing
+
+    Keeps the position of the directory read, so the next
+    readdir() call with the matching offset continues from
+    the same place instead of rereading the directory.
+
+     * fid -- Fid of the open directory
+     * offset -- 9p read offset of the next chunk
+     * index -- number of the entries already passed
+     * entries -- the current decoded chunk
+     * pos -- position in the current chunk
+    """
+    def __init__(self, fid):
+        self.fid = fid
+        self.session = fid.session
+        self.offset = 0
+        self.index = 0
+        self.entries = []
+        self.pos = 0
+
+    def seek(self, index):
+        """
+        Rewind to the entry number `index` within the current
+        chunk; return False if it is not possible
+        """
+        back = self.index - index
+        if back < 0 or back > self.pos:
+            return False
+        self.pos -= back
+        self.index = index
+        return True
+
+
+class CacheFill(object):
+    """
+    Cache entry being fetched
+
+    Data read from the server is appended to a temporary
+    file while the reads go sequentially from the start
+    of the file. When the whole file is fetched, the entry
+    can be committed to the cache.
+    """
+    def __init__(self, name, fname, length):
+        self.name = name
+        self.fname = fname
+        self.length = length
+        self.offset = 0
+        self.fd = open(fname, "wb")
+
+    def feed(self, offset, data):
+        """
+        Save the data block, if it continues the fetched part
+        """
+        if offset == self.offset and data:
+            self.fd.write(data)
+            self.offset += len(data)
+
+    @property
+    def complete(self):
+        return self.offset == self.length
+
+
+class DiskCache(object):
+    """
+    Persistent read cache
+
+    Keeps whole-file copies of the remote files in a local
+    directory, so they survive restarts and reconnects. The
+    entries are keyed by qid.path, qid.vers, mtime and length,
+    so any change on the server side makes the old copy
+    unreachable. The total size is limited by `limit` bytes;
+    the least recently used copies are evicted first.
+    """
+    def __init__(self, path, limit=CACHE_SIZE):
+        """
+         * path -- the cache directory, created if missing
+         * limit -- the cache size budget, in bytes
+        """
+        self.path = os.path.realpath(path)
+        self.limit = limit
+        self.size = 0
+        self.entries = {}
+        self._lock = threading.Lock()
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        for name in os.listdir(self.path):
+            fname = os.path.join(self.path, name)
+            if name.endswith(".part"):
+                # leftovers of an interrupted fetch
+                os.unlink(fname)
+                continue
+            s = os.stat(fname)
+            self.entries[name] = [s.st_size, s.st_atime]
+            self.size += s.st_size
+        with self._lock:
+            self._evict(0)
+
+    def key(self, inode):
+        """
+        Cache entry name for the py9p.Dir
+        """
+        return "%016x.%08x.%x.%x" % (inode.qid.path, inode.qid.vers,
+                inode.mtime, inode.length)
+
+    def _evict(self, size):
+        """
+        Drop LRU entries to free `size` bytes in the budget
+        """
+        if self.size + size <= self.limit:
+            return
+        for name in sorted(self.entries,
+                key=lambda x: self.entries[x][1]):
+            self._drop(name)
+            if self.size + size <= self.limit:
+                break
+
+    def _drop(self, name):
+        self.size -= self.entries.pop(name)[0]
+        try:
+            os.unlink(os.path.join(self.path, name))
+        except OSError:
+            pass
+
+    def lookup(self, inode):
+        """
+        Return open local copy for the py9p.Dir, or None
+        """
+        name = self.key(inode)
+        with self._lock:
+            if name not in self.entries:
+                return None
+            fname = os.path.join(self.path, name)
+            try:
+                fd = open(fname, "rb")
+            except IOError:
+                self._drop(name)
+                return None
+            self.entries[name][1] = time.time()
+        try:
+            os.utime(fname, None)
+        except OSError:
+            pass
+        return fd
+
+    def begin(self, inode):
+        """
+        Start fetching a new entry; return CacheFill or None,
+        if the file does not fit the cache at all
+        """
+        if inode.length > self.limit:
+            return None
+        name = self.key(inode)
+        fname = os.path.join(self.path, "%s.%x.part" % (name, id(inode)))
+        try:
+            return CacheFill(name, fname, inode.length)
+        except IOError:
+            return None
+
+    def commit(self, fill):
+        """
+        Finish the fetch: move a complete entry into the cache,
+        drop an incomplete one
+        """
+        fill.fd.close()
+        if not fill.complete:
+            try:
+                os.unlink(fill.fname)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            self.invalidate(int(fill.name.split(".")[0], 16), lock=False)
+            self._evict(fill.length)
+            os.rename(fill.fname, os.path.join(self.path, fill.name))
+            self.entries[fill.name] = [fill.length, time.time()]
+            self.size += fill.length
+
+    def invalidate(self, path, lock=True):
+        """
+        Drop all the cached copies of the file with qid.path
+        """
+        prefix = "%016x." % (path)
+        if lock:
+            self._lock.acquire()
+        try:
+            for name in [x for x in self.entries if x.startswith(prefix)]:
+                self._drop(name)
+        finally:
+            if lock:
+                self._lock.release()
 
 
 class ClientFS(fuse.Fuse):
@@ -198,8 +432,12 @@ class ClientFS(fuse.Fuse):
     Implements all the proxying of FUSE calls to 9p
     server. Can authomatically reconnect to the server.
     """
+    # rename() copy progress callback: progress(done, total)
+    progress = None
+
     def __init__(self, address, credentials, mountpoint,
-            debug=False, timeout=10, keep_reconnect=False):
+            debug=False, timeout=10, keep_reconnect=False,
+            cache=None, cache_size=CACHE_SIZE):
         """
          * address -- (address,port) of the 9p server, tuple
          * credentials -- py9p.Credentials
@@ -207,6 +445,8 @@ class ClientFS(fuse.Fuse):
          * debug -- FUSE and py9p debug output, implies foreground run
          * timeout -- socket timeout
          * keep_reconnect -- whether to try reconnect after errors
+         * cache -- persistent read cache directory, None to disable
+         * cache_size -- read cache size budget, in bytes
         """
 
         self.address = address
@@ -220,12 +460,21 @@ class ClientFS(fuse.Fuse):
         self.keep_reconnect = keep_reconnect
         self._lock = threading.Lock()
         self._rlock = threading.RLock()
+        self._guarded = threading.local()
         self._interval = 1
         self._reconnect_event = threading.Event()
         self._connected_event = threading.Event()
         self.fidcache = FidCache()
+        self.openfids = {}
+        self.session = 0
+        self.cache = None
+        if cache is not None:
+            self.cache = DiskCache(cache, cache_size)
         self._reconnect(init=True)
-        self.dircache = {}
+        self.dircache = py9p.LRUCache(DIRCACHE_SIZE)
+        self.versions = py9p.LRUCache(DIRCACHE_SIZE)
+        self.dircursors = py9p.LRUCache(MAX_DIRCURSORS,
+                onevict=self._closedir)
         self.tfidcache = FidCache(start=MIN_TFID, limit=MAX_TFID)
 
         fuse.Fuse.__init__(self, version="%prog " + fuse.__version__,
@@ -272,6 +521,34 @@ class ClientFS(fuse.Fuse):
                 print(str(self.exit))
                 sys.exit(255)
 
+    def _replay(self):
+        """
+        Reopen the tracked open files on the new session, so
+        FUSE file handles stay valid after reconnection.
+        """
+        for f in list(self.openfids.values()):
+            try:
+                self.client._walk(self.client.ROOT,
+                        f.fid, filter(None, f.path.split("/")))
+                # do not truncate the file once more
+                fcall = self.client._open(f.fid,
+                        py9p.open2plan(f.mode & ~os.O_TRUNC))
+                f.iounit = fcall.iounit or f.iounit
+                f.session = self.session
+            except Exception:
+                # the file is gone; I/O on it will fail
+                if self.debug:
+                    traceback.print_exc()
+
+    def _track(self, f, path, mode):
+        """
+        Remember the open Fid to replay it after reconnection
+        """
+        f.path = path
+        f.mode = mode
+        f.session = self.session
+        self.openfids[f.fid] = f
+
     def _reconnect_interval(self):
         """
         Return next reconnection interval in seconds.
@@ -298,13 +575,17 @@ class ClientFS(fuse.Fuse):
                     self.sock = socket.socket(socket.AF_INET)
                 self.sock.settimeout(self.timeout)
                 self.sock.connect(self.address)
-                self.client = py9p.Client(
+                client = py9p.Client(
                         fd=self.sock,
                         chatty=self.debug,
                         credentials=self.credentials,
                         dotu=dotu, msize=self.msize)
-                self.msize = self.client.msize
-                self.fidcache.iounit = self.client.msize - py9p.IOHDRSZ
+                with self._rlock:
+                    self.client = client
+                    self.session += 1
+                    self.msize = self.client.msize
+                    self.fidcache.iounit = self.client.msize - py9p.IOHDRSZ
+                    self._replay()
                 self._connected_event.set()
                 self._lock.release()
                 return
@@ -339,14 +620,41 @@ class ClientFS(fuse.Fuse):
     @guard
     def open(self, tfid, path, mode):
         f = self.fidcache.acquire()
+        readonly = (mode & 3) == os.O_RDONLY and not (mode & os.O_TRUNC)
         try:
             self.client._walk(self.client.ROOT,
                     f.fid, filter(None, path.split("/")))
+            # one Tstat revalidates both the kernel page cache
+            # and the local copy
+            inode = self.client._stat(f.fid).stat[0]
+            self.dircache[py9p.hash8(path)] = inode
+            version = (inode.qid.vers, inode.mtime, inode.length)
+            if readonly:
+                f.keep_cache = self.versions.get(inode.qid.path) == version
+                self.versions[inode.qid.path] = version
+            else:
+                self.versions.pop(inode.qid.path, None)
+            if self.cache is not None and readonly:
+                f.cache = self.cache.lookup(inode)
+                if f.cache is not None:
+                    # the file will be served locally
+                    self.client._clunk(f.fid)
+                    self.fidcache.release(f)
+                    f.fid = None
+                    return f
+                f.fill = self.cache.begin(inode)
             fcall = self.client._open(f.fid, py9p.open2plan(mode))
+            if self.cache is not None and not readonly:
+                self.cache.invalidate(fcall.qid.path)
             f.iounit = fcall.iounit
+            self._track(f, path, mode)
             return f
         except Exception as e:
-            self.fidcache.release(f)
+            if f.fill is not None:
+                self.cache.commit(f.fill)
+                f.fill = None
+            if f.fid is not None:
+                self.fidcache.release(f)
             raise e
 
     @guard
@@ -406,7 +714,7 @@ class ClientFS(fuse.Fuse):
         self.client._walk(self.client.ROOT,
                 tfid, filter(None, path.split("/")))
         self.client._remove(tfid)
-        self.dircache = {}
+        self.dircache.clear()
 
     def rmdir(self, path):
         self.unlink(path)
@@ -458,10 +766,9 @@ class ClientFS(fuse.Fuse):
 
     @guard
     def write(self, tfid, path, buf, offset, f):
-        if py9p.hash8(path) in self.dircache:
-            del self.dircache[py9p.hash8(path)]
+        self.dircache.pop(py9p.hash8(path))
         size = len(buf)
-        for i in range((size + f.iounit - 1) / f.iounit):
+        for i in range((size + f.iounit - 1) // f.iounit):
             start = i * f.iounit
             length = start + f.iounit
             self.client._write(f.fid, offset + start,
@@ -470,6 +777,10 @@ class ClientFS(fuse.Fuse):
 
     @guard
     def read(self, tfid, path, size, offset, f):
+        if f.cache is not None:
+            f.cache.seek(offset)
+            return f.cache.read(size)
+        start = offset
         data = bytes()
         i = 0
         while True:
@@ -482,6 +793,8 @@ class ClientFS(fuse.Fuse):
             if size <= len(data) or len(ret.data) == 0:
                 break
             i += 1
+        if f.fill is not None:
+            f.fill.feed(start, data[:size])
         return data[:size]
 
     @guard
@@ -493,8 +806,7 @@ class ClientFS(fuse.Fuse):
         # dir, which can be done with wstat()
 
         for i in (path, dest):
-            if py9p.hash8(i) in self.dircache:
-                del self.dircache[py9p.hash8(i)]
+            self.dircache.pop(py9p.hash8(i))
 
         # if we can use wstat():
         if path.split("/")[:-1] == dest.split("/")[:-1]:
@@ -508,41 +820,159 @@ class ClientFS(fuse.Fuse):
         # abort on EIO
         if -errno.EIO in (source, destination):
             return -errno.EIO
-        # create the destination file
+        # create the destination tree and collect the files to copy
+        jobs = []
+        removals = []
+        self._copytree(path, dest, source, destination, jobs, removals)
+        # copy the content
+        ret = self._copy(jobs)
+        if ret is not None:
+            return ret
+        # remove the source, the content goes first
+        for i in removals:
+            self.unlink(i)
+
+    def _copytree(self, path, dest, source, destination, jobs, removals):
+        """
+        Create the destination entry for `path`, recursively for
+        directories, and collect (path, dest, size) copy jobs and
+        the source entries to remove
+        """
         if destination == -errno.ENOENT:
             self.mknod(dest, source.st_mode, 0)
         if source.st_mode & stat.S_IFDIR:
-            # move all the content to the new directory
             for i in self._readdir(path, 0):
-                self.rename(
+                self._copytree(
                         "/".join((path, i.name)),
-                        "/".join((dest, i.name)))
+                        "/".join((dest, i.name)),
+                        fStat(i), -errno.ENOENT, jobs, removals)
         else:
-            # open both files
-            sf = self.open(path, os.O_RDONLY)
-            df = self.open(dest, os.O_WRONLY | os.O_TRUNC)
-            # copy the content
-            for i in range((source.st_size + self.msize - 1) / self.msize):
-                block = self.read(path, self.msize, i * self.msize, sf)
-                self.write(dest, block, i * self.msize, df)
-            # close files
-            self.release(path, 0, sf)
-            self.release(dest, 0, df)
-        # remove the source
-        self.unlink(path)
+            jobs.append((path, dest, source.st_size))
+        removals.append(path)
+
+    @guard
+    def _openfid(self, tfid, path, mode):
+        f = self.fidcache.acquire()
+        try:
+            self.client._walk(self.client.ROOT,
+                    f.fid, filter(None, path.split("/")))
+            f.iounit = self.client._open(f.fid,
+                    py9p.open2plan(mode)).iounit or f.iounit
+        except Exception as e:
+            self.fidcache.release(f)
+            raise e
+        self._track(f, path, mode)
+        return f
+
+    @guard
+    def _copy(self, tfid, jobs):
+        """
+        Copy the files content with pipelined reads and writes;
+        up to COPY_FILES files are copied at once, every file
+        has up to COPY_DEPTH reads in flight
+        """
+        jobs = list(jobs)
+        total = sum([x[2] for x in jobs])
+        done = 0
+        active = []
+        writes = []
+        depth = max(1, PIPELINE_WINDOW // self.msize)
+        try:
+            while jobs or active:
+                while jobs and len(active) < COPY_FILES:
+                    (path, dest, size) = jobs.pop(0)
+                    job = CopyJob(path, dest, size)
+                    active.append(job)
+                    job.sf = self._openfid(path, os.O_RDONLY)
+                    job.df = self._openfid(dest, os.O_WRONLY | os.O_TRUNC)
+                    if not isinstance(job.sf, Fid) or \
+                            not isinstance(job.df, Fid):
+                        return -errno.EIO
+                # the writes of the previous round go along with
+                # the reads of the next one
+                reads = []
+                for job in active:
+                    for i in range(COPY_DEPTH):
+                        if job.eof:
+                            break
+                        fcall = py9p.Fcall(py9p.Tread)
+                        fcall.fid = job.sf.fid
+                        fcall.offset = job.offset
+                        fcall.count = min(job.sf.iounit, job.df.iounit,
+                                self.msize - py9p.IOHDRSZ)
+                        fcall.job = job
+                        reads.append(fcall)
+                        job.offset += fcall.count
+                        job.eof = job.offset >= job.size
+                replies = self.client._pipeline(writes + reads, depth)
+                retries = []
+                for (wcall, ret) in zip(writes, replies):
+                    done += ret.count
+                    if ret.count >= len(wcall.data):
+                        continue
+                    if ret.count == 0:
+                        # the server takes no more data; keep
+                        # the source, as rename() removes it
+                        return -errno.EIO
+                    # a short write: re-issue the remainder
+                    fcall = py9p.Fcall(py9p.Twrite)
+                    fcall.fid = wcall.fid
+                    fcall.offset = wcall.offset + ret.count
+                    fcall.data = wcall.data[ret.count:]
+                    retries.append(fcall)
+                replies = replies[len(writes):]
+                writes = retries
+                for (fcall, ret) in zip(reads, replies):
+                    if len(ret.data) < fcall.count:
+                        # the file is shorter than expected
+                        fcall.job.eof = True
+                    if not ret.data:
+                        continue
+                    wcall = py9p.Fcall(py9p.Twrite)
+                    wcall.fid = fcall.job.df.fid
+                    wcall.offset = fcall.offset
+                    wcall.data = ret.data
+                    writes.append(wcall)
+                if self.progress is not None:
+                    self.progress(done, total)
+                elif self.debug:
+                    print("copied %s of %s bytes" % (done, total))
+                # close the files with no more requests pending
+                pending = set([x.fid for x in writes])
+                for job in [x for x in active
+                        if x.eof and x.df.fid not in pending]:
+                    active.remove(job)
+                    self.release(job.path, 0, job.sf)
+                    self.release(job.dest, 0, job.df)
+        finally:
+            for job in active:
+                for f in (job.sf, job.df):
+                    if isinstance(f, Fid):
+                        self.release(job.path, 0, f)
 
     @guard
     def release(self, tfid, path, flags, f):
+        if f.cache is not None:
+            f.cache.close()
+            f.cache = None
+        if f.fill is not None:
+            self.cache.commit(f.fill)
+            f.fill = None
+        if f.fid is None:
+            return
+        self.openfids.pop(f.fid, None)
         try:
             self.client._clunk(f.fid)
-            self.fidcache.release(f)
         except:
             pass
+        # a fid that failed to clunk is dead anyway
+        self.fidcache.release(f)
 
     @guard
     def readlink(self, tfid, path):
-        if py9p.hash8(path) in self.dircache:
-            return self.dircache[py9p.hash8(path)].extension
+        inode = self.dircache.get(py9p.hash8(path))
+        if inode is not None:
+            return inode.extension
         self.client._walk(self.client.ROOT,
                 tfid, filter(None, path.split("/")))
         self.client._open(tfid, py9p.OREAD)
@@ -552,8 +982,9 @@ class ClientFS(fuse.Fuse):
 
     @guard
     def _getattr(self, tfid, path):
-        if py9p.hash8(path) in self.dircache:
-            return fStat(self.dircache[py9p.hash8(path)])
+        inode = self.dircache.get(py9p.hash8(path))
+        if inode is not None:
+            return fStat(inode)
 
         self.client._walk(self.client.ROOT,
                 tfid, filter(None, path.split("/")))
@@ -578,6 +1009,17 @@ class ClientFS(fuse.Fuse):
                     return -errno.ENOENT
         return s
 
+    def _decdir(self, data):
+        """
+        Decode the directory entries from Rread data
+        """
+        p9 = py9p.Marshal9P(dotu=self.dotu)
+        p9.setBuffer(data)
+        p9.buf.seek(0)
+        fcall = py9p.Fcall(py9p.Rstat)
+        p9.decstat(fcall.stat, 0)
+        return fcall.stat
+
     @guard
     def _readdir(self, tfid, path, offset):
         dirs = []
@@ -590,25 +1032,80 @@ class ClientFS(fuse.Fuse):
             if len(ret.data) == 0:
                 break
             offset += len(ret.data)
-            p9 = py9p.Marshal9P(dotu=self.dotu)
-            p9.setBuffer(ret.data)
-            p9.buf.seek(0)
-            fcall = py9p.Fcall(py9p.Rstat)
-            p9.decstat(fcall.stat, 0)
-            dirs.extend(fcall.stat)
+            dirs.extend(self._decdir(ret.data))
         self.client._clunk(tfid)
         return dirs
 
+    @guard
+    def _opendir(self, tfid, path):
+        f = self.fidcache.acquire()
+        try:
+            self.client._walk(self.client.ROOT,
+                    f.fid, filter(None, path.split("/")))
+            self.client._open(f.fid, py9p.OREAD)
+        except Exception as e:
+            self.fidcache.release(f)
+            raise e
+        self._track(f, path, os.O_RDONLY)
+        return DirCursor(f)
+
+    @guard
+    def _readdirchunk(self, tfid, cursor):
+        skip = 0
+        if cursor.session != cursor.fid.session:
+            # the directory was reopened on a new session,
+            # reread it skipping the entries already passed
+            cursor.session = cursor.fid.session
+            cursor.offset = 0
+            skip = cursor.index
+        while True:
+            ret = self.client._read(cursor.fid.fid,
+                    cursor.offset, self.msize)
+            cursor.offset += len(ret.data)
+            entries = self._decdir(ret.data)
+            if skip < len(entries) or not entries:
+                return entries[skip:]
+            skip -= len(entries)
+
+    def _closedir(self, path, cursor):
+        self.release(path, 0, cursor.fid)
+
     def readdir(self, path, offset):
         self._interval = 1
         self._reconnect_event.set()
 
-        dirs = self._readdir(path, offset)
-        if not isinstance(dirs, list):
-            dirs = []
+        # resume the cursor, left by the previous call, if it
+        # is still near the offset; otherwise reread from the start,
+        # as for offset 0 -- the rewinddir() after changes
+        cursor = self.dircursors.pop(path, None)
+        if cursor is not None and (offset == 0 or not cursor.seek(offset)):
+            self._closedir(path, cursor)
+            cursor = None
+        if cursor is None:
+            cursor = self._opendir(path)
+            if not isinstance(cursor, DirCursor):
+                return
 
         if path == "/":
             path = ""
-        for i in dirs:
-            self.dircache[py9p.hash8("/".join((path, i.name)))] = i
-            yield fuse.Direntry(i.name)
+        try:
+            while True:
+                if cursor.pos == len(cursor.entries):
+                    entries = self._readdirchunk(cursor)
+                    if not isinstance(entries, list) or not entries:
+                        break
+                    cursor.entries = entries
+                    cursor.pos = 0
+                i = cursor.entries[cursor.pos]
+                cursor.pos += 1
+                cursor.index += 1
+                if cursor.index <= offset:
+                    continue
+                self.dircache[py9p.hash8("/".join((path, i.name)))] = i
+                yield fuse.Direntry(i.name, offset=cursor.index)
+            self._closedir(path or "/", cursor)
+            cursor = None
+        finally:
+            # FUSE stops the iteration when its buffer is full
+            if cursor is not None:
+                self.dircursors[path or "/"] = cursor
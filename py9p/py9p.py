@@ -25,6 +25,7 @@
 """
 
 import os
+import errno
 import stat
 import sys
 import socket
@@ -33,6 +34,8 @@ import traceback
 import io
 import threading
 import struct
+import time
+from collections import OrderedDict
 from . import utils as c9
 
 if sys.version_info[0] == 3:
@@ -268,6 +271,10 @@ class Marshal9P(object):
         """Decode Qid structure"""
         return Qid(self.dec1(), self.dec4(), self.dec8())
 
+    # Twrite payload handling, see recvwrite()
+    bufpool = None
+    splice = False
+
     def __init__(self, dotu=0, chatty=False):
         self.chatty = chatty
         self.dotu = dotu
@@ -301,8 +308,19 @@ class Marshal9P(object):
                     fcall.tag, fcall.tostr()))
             self.enc(fcall)
             self.buf.seek(0)
-            self.enc4(self.length)
-            fd.write(self.buf.getvalue())
+            if fcall.type == Rread and fcall.filerange is not None:
+                # zero-copy: only the header goes through the buffer,
+                # the payload is sent right from the file
+                ffd, offset, count = fcall.filerange
+                self.enc4(self.length + count)
+                fd.sendfile(ffd, offset, count, self.buf.getvalue())
+            elif fcall.type == Rread and isinstance(fcall.data, memoryview):
+                # the data is a slice of some fs buffer, don't copy it
+                self.enc4(self.length + len(fcall.data))
+                fd.writev((self.buf.getvalue(), fcall.data))
+            else:
+                self.enc4(self.length)
+                fd.write(self.buf.getvalue())
 
     def recv(self, fd):
         "Read and decode a message"
@@ -310,7 +328,13 @@ class Marshal9P(object):
             size = struct.unpack("I", fd.read(4))[0]
             if size > 0xffffffff or size < 7:
                 raise Error("Bad message size: %d" % size)
-            self.setBuffer(fd.read(size - 4))
+            if self.bufpool is None and not self.splice:
+                self.setBuffer(fd.read(size - 4))
+            else:
+                head = fd.read(3)
+                if struct.unpack("=B", head[:1])[0] == Twrite and size >= 23:
+                    return self.recvwrite(fd, size, head)
+                self.setBuffer(head + fd.read(size - 7))
             self.buf.seek(0)
             mtype, tag = self.decF("=BH", 3)
             self._checkType(mtype)
@@ -322,6 +346,29 @@ class Marshal9P(object):
                         tag, fcall.tostr()))
             return fcall
 
+    def recvwrite(self, fd, size, head):
+        """Decode Twrite w/o copying the payload through the buffer:
+        it is received into a pooled buffer, or, with `splice`, left
+        in the socket as a Payload to be moved right into a file"""
+        tag = struct.unpack("=H", head[1:])[0]
+        fid, offset, count = struct.unpack("=IQI", fd.read(16))
+        if count != size - 23:
+            raise Error("Bad Twrite count: %d" % count)
+        fcall = Fcall(Twrite, tag, fid)
+        fcall.offset = offset
+        fcall.count = count
+        if self.splice:
+            fcall.data = None
+            fcall.payload = Payload(fd, count)
+        else:
+            fcall.buffer = self.bufpool.get(count)
+            fcall.data = memoryview(fcall.buffer)[:count]
+            fd.readinto(fcall.data)
+        if self.chatty:
+            print("<-%d- %s %s fid=%s offset=%s count=%s" % (fd.fileno(),
+                    cmdName[Twrite], tag, fid, offset, count))
+        return fcall
+
     def encstat(self, stats, enclen=1):
         statsz = 0
         for x in stats:
@@ -402,7 +449,13 @@ class Marshal9P(object):
             self.encF("=IQI", fcall.fid, fcall.offset,
                     fcall.count)
         elif fcall.type == Rread:
-            self.encD(fcall.data)
+            if fcall.filerange is not None:
+                self.enc4(fcall.filerange[2])
+            elif isinstance(fcall.data, memoryview):
+                # the data goes to the socket as is, see send()
+                self.enc4(len(fcall.data))
+            else:
+                self.encD(fcall.data)
         elif fcall.type == Twrite:
             self.encF("=IQI", fcall.fid, fcall.offset,
                     len(fcall.data))
@@ -605,6 +658,190 @@ def hasperm(f, uid, p):
     return 0
 
 
+class LRUCache(object):
+    """
+    Thread-safe mapping with the least recently used eviction
+
+     * limit -- the maximum total weight of the entries
+     * ttl -- seconds an entry stays valid, None means forever
+     * weigher -- entry weight function, every entry weighs 1 by default
+     * onevict -- callback(key, value) for entries dropped by the cache
+
+    Hits, misses and evictions are counted in the corresponding
+    attributes, so the cache efficiency can be inspected at runtime.
+    """
+
+    def __init__(self, limit=1024, ttl=None, weigher=None, onevict=None):
+        self.limit = limit
+        self.ttl = ttl
+        self.weigher = weigher
+        self.onevict = onevict
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def _drop(self, key, evict=True):
+        value, weight, expires = self._data.pop(key)
+        self.weight -= weight
+        if evict:
+            self.evictions += 1
+            if self.onevict is not None:
+                self.onevict(key, value)
+        return value
+
+    def _expired(self, item):
+        return item[2] is not None and item[2] < time.time()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or self._expired(item):
+                if item is not None:
+                    self._drop(key)
+                self.misses += 1
+                return default
+            # move to the MRU end
+            del self._data[key]
+            self._data[key] = item
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value):
+        weight = 1
+        if self.weigher is not None:
+            weight = self.weigher(value)
+        expires = None
+        if self.ttl is not None:
+            expires = time.time() + self.ttl
+        with self._lock:
+            if key in self._data:
+                self._drop(key, evict=False)
+            if weight > self.limit:
+                return
+            self._data[key] = (value, weight, expires)
+            self.weight += weight
+            while self.weight > self.limit:
+                self._drop(next(iter(self._data)))
+
+    def pop(self, key, default=None):
+        """Remove the entry and return its value, w/o eviction callback"""
+        with self._lock:
+            if key not in self._data:
+                return default
+            return self._drop(key, evict=False)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._data):
+                self._drop(key)
+
+    def keys(self):
+        with self._lock:
+            return list(self._data)
+
+    def __getitem__(self, key):
+        marker = self._data
+        value = self.get(key, marker)
+        if value is marker:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            if key not in self._data:
+                raise KeyError(key)
+            self._drop(key, evict=False)
+
+    def __contains__(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            return item is not None and not self._expired(item)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class BufferPool(object):
+    """
+    Pool of reusable receive buffers
+
+     * size -- buffer size, larger requests get a new buffer
+     * count -- how many free buffers to keep
+    """
+
+    def __init__(self, size, count=16):
+        self.size = size
+        self.count = count
+        self._free = []
+        self._lock = threading.Lock()
+
+    def get(self, size):
+        if size > self.size:
+            return bytearray(size)
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        return bytearray(self.size)
+
+    def put(self, buf):
+        if len(buf) != self.size:
+            return
+        with self._lock:
+            if len(self._free) < self.count:
+                self._free.append(buf)
+
+
+class Payload(object):
+    """Twrite data, still waiting in the socket"""
+
+    def __init__(self, sock, count):
+        self.sock = sock
+        self.count = count
+        self.left = count
+
+    def read(self):
+        """Receive the data"""
+        data = self.sock.read(self.left) if self.left else b""
+        self.left = 0
+        return data
+
+    def splice(self, fd, offset):
+        """Move the data into the file at `offset` through a pipe
+        w/o copying it to the user space; return bytes written"""
+        r, w = self.sock.getpipe()
+        done = 0
+        while self.left > 0:
+            n = os.splice(self.sock.fileno(), w, min(self.left, 65536))
+            if n == 0:
+                raise EofError("client eof")
+            self.left -= n
+            try:
+                while n > 0:
+                    m = os.splice(r, fd, n, offset_dst=offset + done)
+                    n -= m
+                    done += m
+            except:
+                # the pipe may keep a part of the data: drop it,
+                # and keep the stream clean for the next messages
+                self.sock.closepipe()
+                self.drain()
+                raise
+        return done
+
+    def drain(self):
+        """Discard the data, if not consumed by the fs"""
+        while self.left > 0:
+            n = min(self.left, 65536)
+            self.sock.read(n)
+            self.left -= n
+
+
 class Sock(object):
     """Per-connection state and appropriate read and write methods
     for the Marshaller."""
@@ -615,6 +852,7 @@ class Sock(object):
         self.reqs = {}  # reqs are per client
         self.uname = None
         self.closing = False
+        self.pipe = None
         self.marshal = Marshal9P(dotu=dotu, chatty=chatty)
 
     def send(self, x):
@@ -634,12 +872,84 @@ class Sock(object):
             x += b
         return x
 
+    def readinto(self, view):
+        l = len(view)
+        got = 0
+        while got < l:
+            n = self.sock.recv_into(view[got:])
+            if not n:
+                raise EofError("client eof")
+            got += n
+        return got
+
+    def getpipe(self):
+        """Per-connection pipe for splice"""
+        if self.pipe is None:
+            self.pipe = os.pipe()
+        return self.pipe
+
+    def closepipe(self):
+        """Close the splice pipe, the next getpipe() makes a new one"""
+        if self.pipe is not None:
+            os.close(self.pipe[0])
+            os.close(self.pipe[1])
+            self.pipe = None
+
     def write(self, buf):
         if self.closing:
             return len(buf)
         if self.sock.send(buf) != len(buf):
             raise Error("short write")
 
+    def writev(self, bufs):
+        """Write the buffers w/o joining them"""
+        if self.closing:
+            return
+        if not hasattr(self.sock, 'sendmsg'):
+            self.sock.sendall(b"".join(bytes(x) for x in bufs))
+            return
+        bufs = [memoryview(x) for x in bufs if len(x)]
+        while bufs:
+            sent = self.sock.sendmsg(bufs)
+            while bufs and sent >= len(bufs[0]):
+                sent -= len(bufs.pop(0))
+            if sent:
+                bufs[0] = bufs[0][sent:]
+
+    def sendfile(self, fd, offset, count, head=b""):
+        """Send `head` and `count` bytes of the file from `offset`;
+        the message length is already sent, so if the file turns out
+        to be shorter, the connection is shut down and Error raised"""
+        if self.closing:
+            return
+        # w/o MSG_MORE the header goes out as a separate small
+        # segment, and Nagle + delayed ACK stall the payload
+        self.sock.sendall(head, getattr(socket, 'MSG_MORE', 0) if count else 0)
+        while count > 0:
+            if hasattr(os, 'sendfile'):
+                try:
+                    sent = os.sendfile(self.sock.fileno(), fd, offset, count)
+                except OSError as e:
+                    if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                        raise
+                    # not supported for this file, use the copy
+                    sent = -1
+            else:
+                sent = -1
+            if sent < 0:
+                os.lseek(fd, offset, os.SEEK_SET)
+                data = os.read(fd, count)
+                self.sock.sendall(data)
+                sent = len(data)
+            if sent == 0:
+                break
+            offset += sent
+            count -= sent
+        if count > 0:
+            # the client can not tell padding from the file data
+            self.sock.shutdown(socket.SHUT_RDWR)
+            raise Error("file truncated while sent")
+
     def fileno(self):
         return self.sock.fileno()
 
@@ -655,6 +965,7 @@ class Sock(object):
         return None
 
     def close(self):
+        self.closepipe()
         self.sock.close()
 
 
@@ -681,6 +992,9 @@ class Fcall(object):
     offset      # Tread, Twrite
     count       # Tread, Twrite, Rread
     data        # Twrite, Rread
+    filerange   # Rread, (fd, offset, count) to be sent from a file
+    buffer      # Twrite, pooled buffer under the data
+    payload     # Twrite, Payload instead of the data
     nstat       # Twstat, Rstat
     stat        # Twstat, Rstat
 
@@ -697,6 +1011,9 @@ class Fcall(object):
         self.iounit = 8192
         self.ename = None
         self.wqid = None
+        self.filerange = None
+        self.buffer = None
+        self.payload = None
 
     def tostr(self):
         attr = [x for x in dir(self) if not x.startswith('_') and
@@ -733,6 +1050,8 @@ class Fid(object):
         self.uid = None
         self.qid = None
         self.path = path
+        self.diroffset = 0
+        self.dircursor = None
 
         pool[fid] = self
 
@@ -810,6 +1129,47 @@ class Dir(object):
         return marsh.buf.getvalue()
 
 
+class DirCursor(object):
+    """
+    Directory read state of an open fid
+
+    Keeps the directory snapshot, taken by the fs on the first
+    read, and encodes the entries lazily, so every next Tread
+    continues from the place the previous one stopped. The fs
+    can also provide the entries already encoded, as bytes.
+
+    `offset` is the directory offset the cursor has reached.
+    """
+
+    def __init__(self, stats, marshal):
+        self.stats = iter(stats)
+        self.marshal = marshal
+        self.pending = None
+        self.offset = 0
+
+    def read(self, count):
+        """Return up to `count` bytes of the encoded entries"""
+        data = []
+        size = 0
+        while True:
+            if self.pending is None:
+                try:
+                    x = next(self.stats)
+                except StopIteration:
+                    break
+                if isinstance(x, bytes):
+                    self.pending = x
+                else:
+                    self.pending = x.todata(self.marshal)
+            if size + len(self.pending) > count:
+                break
+            data.append(self.pending)
+            size += len(self.pending)
+            self.pending = None
+        self.offset += size
+        return b"".join(data)
+
+
 class Req(object):
     def __init__(self, tag, fd=None, ifcall=None, ofcall=None,
             dir=None, oldreq=None, fid=None, afid=None, newfid=None):
@@ -837,6 +1197,7 @@ class Server(object):
     def __init__(self, listen, authmode=None, fs=None, user=None,
             dom=None, key=None, chatty=False, dotu=False, msize=8192):
         self.msize = msize
+        self.bufpool = BufferPool(msize)
 
         if authmode is None:
             self.authfs = None
@@ -881,6 +1242,13 @@ class Server(object):
         # XXX: for now only allow one mount
         # in the future accept fs/root and
         # handle different filesystems at walk time
+        #
+        # the fs can declare, how it accepts Twrite data:
+        #  * fs.rawwrite -- a memoryview of a pooled buffer,
+        #    valid until respond()
+        #  * fs.splicewrite -- Fcall.payload to be spliced or
+        #    read by the write handler before respond(); on systems
+        #    w/o os.splice() falls back to rawwrite
         self.fs = fs
 
     def shutdown(self, sock):
@@ -947,6 +1315,12 @@ class Server(object):
                     cl, addr = s.accept()
                     self.readpool.append(cl)
                     self.activesocks[cl] = Sock(cl, self.dotu, self.chatty)
+                    if getattr(self.fs, 'splicewrite', False) and \
+                            hasattr(os, 'splice'):
+                        self.activesocks[cl].marshal.splice = True
+                    elif getattr(self.fs, 'rawwrite', False) or \
+                            getattr(self.fs, 'splicewrite', False):
+                        self.activesocks[cl].marshal.bufpool = self.bufpool
                     if self.chatty:
                         print("accepted connection from: %s" % str(addr))
                 else:
@@ -958,6 +1332,10 @@ class Server(object):
                         try:
                             func = getattr(self.fs, name)
                             func(self, req)
+                        except Error as e:
+                            if self.chatty:
+                                traceback.print_exc()
+                            self.respond(req, str(e.args[0][1]), e.args[0][0])
                         except:
                             print("error in delayed read response: %s")
                             traceback.print_exc()
@@ -987,6 +1365,13 @@ class Server(object):
         return
 
     def respond(self, req, error=None, errno=None):
+        if req.ifcall.payload is not None:
+            # the part not consumed by the fs
+            req.ifcall.payload.drain()
+        if req.ifcall.buffer is not None:
+            req.ifcall.data = None
+            self.bufpool.put(req.ifcall.buffer)
+            req.ifcall.buffer = None
         name = 'r' + cmdName[req.ifcall.type][1:]
         if hasattr(self, name):
             func = getattr(self, name)
@@ -1215,7 +1600,11 @@ class Server(object):
 
         if len(req.ifcall.wname) == 0:
             req.ofcall.nwqid = 0
-            self.respond(req, None)
+            if hasattr(self.fs, 'clone'):
+                # let the fs know about the new fid
+                self.fs.clone(self, req)
+            else:
+                self.respond(req, None)
         elif hasattr(self.fs, 'walk'):
             self.fs.walk(self, req)
         else:
@@ -1275,6 +1664,7 @@ class Server(object):
         req.fid.qid = req.ofcall.qid
         if req.ofcall.qid.type & QTDIR:
             req.fid.diroffset = 0
+            req.fid.dircursor = None
 
     def tcreate(self, req):
         req.fid = req.sock.getfid(req.ifcall.fid)
@@ -1323,6 +1713,13 @@ class Server(object):
         o = req.fid.omode & 3
         if o != OREAD and o != ORDWR and o != OEXEC:
             return self.respond(req, Ebotch)
+        if (req.fid.qid.type & QTDIR) and req.ifcall.offset != 0 and \
+                req.fid.dircursor is not None:
+            # continue the listing from the cursor, the fs
+            # is asked only on the first read
+            if req.ifcall.offset != req.fid.dircursor.offset:
+                return self.respond(req, Ebadoffset)
+            return self.respond(req, None)
         if hasattr(self.fs, 'read'):
             self.fs.read(self, req)
         else:
@@ -1333,16 +1730,11 @@ class Server(object):
             return
 
         if req.fid.qid.type & QTDIR:
-            data = b""
-            for x in req.ofcall.stat:
-                ndata = x.todata(req.sock.marshal)
-                if (len(data) - req.ifcall.offset) + \
-                        len(ndata) < req.ifcall.count:
-                    data = data + ndata
-                else:
-                    break
-            req.ofcall.data = data[req.ifcall.offset:]
-            req.fid.diroffset = req.ifcall.offset + len(req.ofcall.data)
+            if req.ifcall.offset == 0 or req.fid.dircursor is None:
+                req.fid.dircursor = DirCursor(req.ofcall.stat,
+                        req.sock.marshal)
+            req.ofcall.data = req.fid.dircursor.read(req.ifcall.count)
+            req.fid.diroffset = req.fid.dircursor.offset
 
     def twrite(self, req):
         req.fid = req.sock.getfid(req.ifcall.fid)
@@ -1351,6 +1743,10 @@ class Server(object):
         if req.ifcall.count < 0 or req.ifcall.offset < 0:
             return self.respond(req, Ebotch)
         if req.fid.qid.type & QTAUTH and self.authfs:
+            if req.ifcall.payload is not None:
+                req.ifcall.data = req.ifcall.payload.read()
+            if isinstance(req.ifcall.data, memoryview):
+                req.ifcall.data = req.ifcall.data.tobytes()
             self.authfs.write(self, req)
             return
         # auth Tread goes w/o omode, there was no open()
@@ -1568,6 +1964,38 @@ class Client(object):
         fcall.oldtag = tag
         return self._rpc(fcall)
 
+    def _pipeline(self, fcalls, depth=8):
+        """
+        Send the requests w/o waiting for the replies one by one,
+        keeping up to `depth` requests in flight. Return the
+        replies in the order of the requests.
+
+        The window should be small enough, so the replies in
+        flight fit the socket buffers.
+        """
+        replies = {}
+        for tag, fcall in enumerate(fcalls):
+            fcall.tag = tag % (NOTAG - 1) + 1
+        sent = 0
+        while len(replies) < len(fcalls):
+            while sent < len(fcalls) and sent - len(replies) < depth:
+                self.fd.send(fcalls[sent])
+                sent += 1
+            ifcall = self.fd.recv()
+            replies[ifcall.tag] = ifcall
+        ret = []
+        for fcall in fcalls:
+            if fcall.tag not in replies:
+                raise RpcError("invalid tag received")
+            ifcall = replies[fcall.tag]
+            if ifcall.type == Rerror:
+                raise RpcError(ifcall.ename)
+            if ifcall.type != fcall.type + 1:
+                raise ClientError("incorrect reply from server: %r" %
+                        [fcall.type, fcall.tag])
+            ret.append(ifcall)
+        return ret
+
     def _fullclose(self):
         self._clunk(self.ROOT)
         self._clunk(self.CWD)
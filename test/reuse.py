@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""
+Inode reuse check: a file, created right after a directory is
+removed, may get the same inode, and so the same qid.path; the
+server must not give it the qid type of the removed directory.
+
+Run against a writable 9pfs on localhost:10001, e.g.:
+
+    9pfs -w -p 10001 -r /tmp/export
+"""
+import socket
+import sys
+import os
+from py9p import py9p
+
+if __name__ == "__main__":
+
+    user = os.environ.get('USER', 'none')
+
+    sock = socket.socket(socket.AF_INET)
+    try:
+        sock.connect(('localhost', 10001),)
+    except socket.error as e:
+        print("%s" % (e.args[1]))
+        sys.exit(255)
+
+    cl = py9p.Client(sock, py9p.Credentials(user), None)
+
+    cl.create('/reuse', py9p.DMDIR | 0o755, py9p.OREAD)
+    cl.close()
+    reused = 0
+    failed = 0
+    for x in range(100):
+        d = cl.create('/reuse/dir', py9p.DMDIR | 0o755, py9p.OREAD).qid
+        cl.close()
+        cl.rm('/reuse/dir')
+        f = cl.create('/reuse/file', 0o644, py9p.OWRITE).qid
+        cl.close()
+        if f.path == d.path:
+            reused += 1
+            if f.type & py9p.QTDIR:
+                failed += 1
+        try:
+            cl.rm('/reuse/file')
+        except py9p.RpcError as e:
+            # e.g. rmdir() on the file
+            print("can not remove the file: %s" % (e.args[0]))
+            sys.exit(1)
+    cl.rm('/reuse')
+
+    print("%d of 100 files reused the inode, %d got a directory qid" %
+            (reused, failed))
+    if failed:
+        sys.exit(1)